@@ -86,7 +86,8 @@ doctype_js = {
 # ------------
 
 # before_install = "indiazona_custom.install.before_install"
-# after_install = "indiazona_custom.install.after_install"
+after_install = "indiazona_custom.install.after_install"
+after_migrate = "indiazona_custom.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -146,6 +147,9 @@ doc_events = {
 	},
     "CRM Task": {
         "on_update": "indiazona_custom.utils.auto_task.handle_task_status_change"
+    },
+    "System Settings": {
+        "on_update": "indiazona_custom.utils.auto_task.clear_default_sender_email_cache"
     }
 }
 
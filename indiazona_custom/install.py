@@ -0,0 +1,30 @@
+import frappe
+
+
+def after_install():
+    add_crm_task_indexes()
+
+
+def after_migrate():
+    # Patches are marked as done on install without running, so the indexes are (re)checked here too
+    add_crm_task_indexes()
+
+
+def add_crm_task_indexes():
+    """
+    Add indexes for the scheduled CRM Task queries, existing indexes are left alone
+    Equality columns come first so the range column (date) can still use the index
+    """
+    # check_all_pending_retry_tasks
+    frappe.db.add_index(
+        "CRM Task",
+        ["status", "custom_retry_created", "due_date"],
+        index_name="idx_crm_task_retry_sweep"
+    )
+    
+    # send_callback_notifications
+    frappe.db.add_index(
+        "CRM Task",
+        ["custom_callback_notification_sent", "custom_callback_date__time"],
+        index_name="idx_crm_task_callback_due"
+    )
@@ -0,0 +1,8 @@
+from indiazona_custom.install import add_crm_task_indexes
+
+
+def execute():
+    """
+    Add indexes for the scheduled CRM Task queries on sites that already have the app
+    """
+    add_crm_task_indexes()
@@ -0,0 +1,22 @@
+import frappe
+
+
+def execute():
+    """
+    Fill empty or non-numeric attempt counters before the columns become Int
+    Blank values are what the retry sweep already treated as attempt 1 of 10
+    """
+    if not frappe.db.has_column("CRM Task", "custom_attempt_number"):
+        return
+    
+    frappe.db.sql("""
+        UPDATE `tabCRM Task`
+        SET custom_attempt_number = '1'
+        WHERE IFNULL(custom_attempt_number, '') NOT REGEXP '^[0-9]+$'
+    """)
+    
+    frappe.db.sql("""
+        UPDATE `tabCRM Task`
+        SET custom_max_attempts = '10'
+        WHERE IFNULL(custom_max_attempts, '') NOT REGEXP '^[0-9]+$'
+    """)
@@ -21,17 +21,12 @@ frappe.ui.form.on('CRM Lead', {
             });
             
             frappe.call({
-                method: 'indiazona_custom.utils.auto_task.check_all_pending_retry_tasks',
+                method: 'indiazona_custom.utils.auto_task.queue_retry_check',
                 callback: function(r) {
                     frappe.show_alert({
-                        message: __('Retry check completed!'),
+                        message: __('Retry check queued!'),
                         indicator: 'green'
                     });
-                    
-                    // Reload page after 1 second to show new tasks
-                    setTimeout(function() {
-                        frm.reload_doc();
-                    }, 1000);
                 }
             });
         }, __('Actions'));
@@ -1,46 +1,97 @@
+import json
+from string import Template
+
 import frappe
 from frappe import _
-from frappe.utils import nowdate, add_days, now_datetime, add_to_date
+from frappe.model.naming import set_new_name
+from frappe.utils import nowdate, add_days, now, now_datetime, add_to_date, get_fullname
+
+DEFAULT_SENDER_CACHE_KEY = "indiazona:default_sender"
+
+RETRY_SWEEP_CHUNK_SIZE = 500
+RETRY_SWEEP_JOB_ID = "indiazona_retry_sweep"
+
+REENGAGEMENT_EMAIL_TEMPLATE = Template("""
+    <p>Dear $first_name,</p>
+    
+    <p>We noticed you showed interest in our services a couple of weeks ago.</p>
+    
+    <p>We understand that timing is everything, and we'd love to reconnect with you to see if there's anything we can help you with now.</p>
+    
+    <p>If you have any questions or would like to discuss how we can support you, please don't hesitate to reach out.</p>
+    
+    <p>Looking forward to hearing from you!</p>
+    
+    <p>Best regards,<br>
+    Your Team</p>
+    """)
+
+INTERESTED_EMAIL_TEMPLATE = Template("""
+    <p>Dear $first_name,</p>
+    
+    <p>Thank you so much for expressing interest in our services!</p>
+    
+    <p>We're excited to have the opportunity to work with you and help you achieve your goals.</p>
+    
+    <p>One of our team members will follow up with you within the next 2 days to discuss the next steps.</p>
+    
+    <p>In the meantime, if you have any questions, please feel free to reach out.</p>
+    
+    <p>Best regards,<br>
+    Your Team</p>
+    """)
 
 
 def create_task_for_lead(doc, method=None):
     """
     Create a task when a lead is created
+    During imports the task and ToDo are buffered and bulk inserted on commit
     """
     try:
-        # Create the initial task document
-        task = frappe.get_doc({
-            "doctype": "CRM Task",
-            "title": "Make First Contact",
-            "assigned_to": doc.lead_owner,
-            "status": "Todo",
-            "priority": "Medium",
-            "description": f"Task auto-created for lead {doc.name}",
+        # The hook can fire again for the same lead, the first contact task only exists once
+        # During imports it may still be buffered by raw_insert_doc, not in the table yet
+        if frappe.db.exists("CRM Task", {
             "reference_doctype": "CRM Lead",
             "reference_docname": doc.name,
-            "start_date": nowdate(),
-            "due_date": add_days(nowdate(), 2),  # Due in 2 days
-            "custom_attempt_number": 1,
-            "custom_max_attempts": 10,
-            "custom_retry_interval_days": 2,
-            "custom_lead_name": doc.name
-        })
+            "custom_attempt_number": 1
+        }) or any(
+            task.get("reference_docname") == doc.name and task.get("custom_attempt_number") == 1
+            for task in get_deferred_inserts("CRM Task")
+        ):
+            return
         
-        task.insert(ignore_permissions=True)
+        task_values = get_first_contact_task_values(doc.name, doc.lead_owner)
         
-        # Assign task to lead owner if available
-        if doc.get("lead_owner"):
-            assignment = frappe.get_doc({
-                "doctype": "ToDo",
-                "allocated_to": doc.lead_owner,
-                "reference_type": "CRM Task",
-                "reference_name": task.name,
-                "description": f"Task assigned: {task.title}",
-                "priority": "Medium",
-                "status": "Open"
-            })
-            assignment.insert(ignore_permissions=True)
+        if in_batch_context():
+            task = raw_insert_doc("CRM Task", {**task_values, "_assign": get_assign_value(doc.lead_owner)})
             
+            if doc.get("lead_owner"):
+                raw_insert_doc("ToDo", get_first_contact_todo_values(doc.lead_owner, task["name"], task["title"]))
+            return
+        
+        # Task and ToDo go in together, a failed ToDo must not leave an orphan task behind
+        frappe.db.savepoint("create_lead_task")
+        try:
+            # Create the initial task document
+            task = frappe.get_doc({"doctype": "CRM Task", **task_values})
+            task.insert(ignore_permissions=True)
+            
+            # Assign task to lead owner if available
+            if doc.get("lead_owner"):
+                assignment = frappe.get_doc({
+                    "doctype": "ToDo",
+                    **get_first_contact_todo_values(doc.lead_owner, task.name, task.title)
+                })
+                assignment.insert(ignore_permissions=True)
+        except Exception:
+            frappe.db.rollback(save_point="create_lead_task")
+            raise
+        
+        # Only worth an alert when someone is looking, not for API or background inserts
+        if not frappe.request:
+            return
+        
+        if doc.get("lead_owner"):
             frappe.msgprint(
                 _("Task {0} created and assigned to {1}").format(
                     task.name, doc.lead_owner
@@ -61,154 +112,522 @@ def create_task_for_lead(doc, method=None):
         frappe.throw(_("Failed to create task for lead"))
 
 
-@frappe.whitelist()
+def create_tasks_for_leads(lead_names):
+    """
+    Create the first contact task for many leads with one bulk insert per doctype
+    For code that creates leads in bulk without running the CRM Lead after_insert hook
+    Does not commit, the caller is responsible for that
+    """
+    if not lead_names:
+        return
+    
+    leads_with_task = set(frappe.get_all("CRM Task",
+        filters={
+            "reference_doctype": "CRM Lead",
+            "reference_docname": ["in", list(lead_names)],
+            "custom_attempt_number": 1
+        },
+        pluck="reference_docname"
+    ))
+    
+    tasks, todos = [], []
+    for lead in frappe.get_all("CRM Lead", filters={"name": ["in", list(lead_names)]}, fields=["name", "lead_owner"]):
+        if lead.name in leads_with_task:
+            continue
+        
+        task = make_bulk_row("CRM Task", {
+            **get_first_contact_task_values(lead.name, lead.lead_owner),
+            "_assign": get_assign_value(lead.lead_owner)
+        })
+        tasks.append(task)
+        
+        if lead.lead_owner:
+            todos.append(make_bulk_row(
+                "ToDo", get_first_contact_todo_values(lead.lead_owner, task["name"], task["title"])
+            ))
+    
+    bulk_insert_rows("CRM Task", tasks)
+    bulk_insert_rows("ToDo", todos)
+
+
+def get_first_contact_task_values(lead_name, lead_owner):
+    """
+    Values of the first CRM Task created for a new lead
+    """
+    return {
+        "title": "Make First Contact",
+        "assigned_to": lead_owner,
+        "status": "Todo",
+        "priority": "Medium",
+        "description": f"Task auto-created for lead {lead_name}",
+        "reference_doctype": "CRM Lead",
+        "reference_docname": lead_name,
+        "start_date": nowdate(),
+        "due_date": add_days(nowdate(), 2),  # Due in 2 days
+        "custom_attempt_number": 1,
+        "custom_max_attempts": 10,
+        "custom_retry_interval_days": 2,
+        "custom_lead_name": lead_name
+    }
+
+
+def get_first_contact_todo_values(lead_owner, task_name, task_title):
+    """
+    Values of the ToDo assigning the first CRM Task to the lead owner
+    """
+    return {
+        "allocated_to": lead_owner,
+        "reference_type": "CRM Task",
+        "reference_name": task_name,
+        "description": f"Task assigned: {task_title}",
+        "priority": "Medium",
+        "status": "Open"
+    }
+
+
 def check_all_pending_retry_tasks():
     """
     Daily scheduled job to check all tasks needing retry
+    Pending tasks are split in chunks of RETRY_SWEEP_CHUNK_SIZE, each one processed by its own long job
     """
     try:
-        # Get tasks WITHOUT attempt number filter - let create_retry_task handle it
-        tasks = frappe.get_all("CRM Task",
-            filters={
-                "status": "Call Not Connected",
-                "due_date": [">=", nowdate()],
-                "custom_retry_created": 0
-            },
-            fields=["name", "custom_lead_name", "custom_attempt_number", "assigned_to", "custom_max_attempts"]
-        )
+        today = nowdate()
         
-        frappe.log_error(
-            message=f"Found {len(tasks)} tasks to process",
-            title="Daily Retry Check Started"
-        )
+        # Nothing to do on most days, answered from idx_crm_task_retry_sweep
+        if not frappe.db.count("CRM Task", {
+            "status": "Call Not Connected",
+            "due_date": [">=", today],
+            "custom_retry_created": 0
+        }):
+            return
         
-        # Process all tasks - let create_retry_task decide what to do
-        for task_data in tasks:
-            try:
-                attempt_num = int(task_data.custom_attempt_number) if task_data.custom_attempt_number else 1
-                max_attempts = int(task_data.custom_max_attempts) if task_data.get("custom_max_attempts") else 10
+        # Leads that ran out of attempts first, then the tasks that get a retry
+        for exhausted in (True, False):
+            for tasks in get_pending_retry_task_chunks(today, exhausted):
+                frappe.logger("indiazona_crm").info(f"Queueing {len(tasks)} tasks to process (exhausted: {exhausted})")
                 
-                create_retry_task(
-                    task_data.custom_lead_name,
-                    task_data.name,
-                    attempt_num,
-                    task_data.assigned_to,
-                    max_attempts
-                )
-            except Exception as e:
-                frappe.log_error(
-                    message=f"Error processing task {task_data.name}: {str(e)}",
-                    title="Retry Task Processing Error"
+                frappe.enqueue(
+                    "indiazona_custom.utils.auto_task.process_retry_chunk",
+                    queue="long",
+                    timeout=600,
+                    task_names=[task.name for task in tasks],
+                    today=today,
+                    exhausted=exhausted
                 )
-                continue
                 
     except Exception as e:
+        frappe.db.rollback()
         frappe.log_error(
             message=f"Error in daily retry check: {str(e)}",
             title="Daily Retry Check Error"
         )
 
 
-def create_retry_task(lead_name, previous_task_name, attempt_number, assigned_to, max_attempts=10):
+@frappe.whitelist()
+def queue_retry_check():
+    """
+    Run check_all_pending_retry_tasks in the background
+    While a sweep is still queued, further calls are collapsed into it
+    """
+    frappe.enqueue(
+        "indiazona_custom.utils.auto_task.check_all_pending_retry_tasks",
+        queue="long",
+        job_id=RETRY_SWEEP_JOB_ID,
+        deduplicate=True
+    )
+
+
+def process_retry_chunk(task_names, today, exhausted):
     """
-    Create a retry task for a lead
+    Background job for one chunk of the daily sweep
+    The tasks are read again under a row lock, so a chunk queued twice only creates its retries once
     """
     try:
-        attempt_number = int(attempt_number) if isinstance(attempt_number, str) else attempt_number
-        max_attempts = int(max_attempts) if isinstance(max_attempts, str) else max_attempts
+        tasks = get_pending_retry_tasks(today, exhausted, task_names=task_names)
+        if not tasks:
+            return
+        
+        process_retry_tasks(tasks, today)
+        frappe.db.commit()
+        
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(
+            message=f"Error processing retry chunk starting at {task_names[0]}: {str(e)}",
+            title="Retry Task Processing Error"
+        )
 
-        # Get the previous task to verify status
-        previous_task = frappe.get_doc("CRM Task", previous_task_name)
+
+def get_pending_retry_task_chunks(today, exhausted):
+    """
+    Yield the tasks waiting for a retry in chunks of RETRY_SWEEP_CHUNK_SIZE, ordered by name
+    With exhausted, only the tasks that reached their max attempts, otherwise only the ones below it
+    """
+    last_name = ""
+    
+    while True:
+        tasks = get_pending_retry_tasks(today, exhausted, last_name=last_name)
         
-        if previous_task.get("custom_retry_created"):
-            frappe.log_error(
-                message=f"Task {previous_task_name} already processed, skipping",
-                title="Task Already Processed"
-            )
+        if not tasks:
             return
         
-        # Double check status is still "Call Not Connected"
-        if previous_task.status != "Call Not Connected":
-            frappe.log_error(
-                message=f"Task {previous_task_name} status changed to '{previous_task.status}', skipping retry",
-                title="Status Changed - No Retry"
-            )
+        yield tasks
+        
+        if len(tasks) < RETRY_SWEEP_CHUNK_SIZE:
             return
+        last_name = tasks[-1].name
+
+
+def get_pending_retry_tasks(today, exhausted, last_name="", task_names=None):
+    """
+    Read up to RETRY_SWEEP_CHUNK_SIZE pending tasks after last_name
+    With task_names, only those tasks are read and locked FOR UPDATE
+    """
+    attempt_condition = ">=" if exhausted else "<"
+    values = {"today": today, "last_name": last_name, "limit": RETRY_SWEEP_CHUNK_SIZE}
+    
+    name_condition = ""
+    lock = ""
+    if task_names is not None:
+        name_condition = "AND name IN %(task_names)s"
+        lock = "FOR UPDATE"
+        values["task_names"] = tuple(task_names)
+    
+    return frappe.db.sql(f"""
+        SELECT name, custom_lead_name, assigned_to,
+            custom_attempt_number AS attempt_number,
+            custom_max_attempts AS max_attempts
+        FROM `tabCRM Task`
+        WHERE status = 'Call Not Connected'
+            AND custom_retry_created = 0
+            AND due_date >= %(today)s
+            AND name > %(last_name)s
+            AND custom_attempt_number {attempt_condition} custom_max_attempts
+            {name_condition}
+        ORDER BY name
+        LIMIT %(limit)s
+        {lock}
+    """, values, as_dict=True)
+
+
+def process_retry_tasks(tasks, today=None):
+    """
+    Retry or expire a chunk of pending tasks, the caller is responsible for committing
+    tasks come from get_pending_retry_tasks, so they are already validated
+    today is the date of the sweep, the retry tasks start on it
+    """
+    # Phase 1: build every row in memory, no database writes
+    plan = new_retry_plan()
+    for task_data in tasks:
+        plan_retry_task(
+            plan,
+            task_data.custom_lead_name,
+            task_data.name,
+            task_data.attempt_number,
+            task_data.assigned_to,
+            task_data.max_attempts
+        )
+    
+    # Phase 2: write the whole plan with a handful of statements
+    apply_retry_plan(plan, today or nowdate())
+
+
+def new_retry_plan():
+    """
+    Empty container for the rows produced by plan_retry_task
+    """
+    return {
+        "retry_tasks": [],
+        "todos": [],
+        "processed_tasks": [],
+        "expired_leads": []
+    }
+
+
+def plan_retry_task(plan, lead_name, previous_task_name, attempt_number, assigned_to, max_attempts=10):
+    """
+    Add the rows needed to retry (or expire) a single task to the plan
+    """
+    plan["processed_tasks"].append(previous_task_name)
+    
+    # Lead has run out of attempts, it gets dropped instead of retried
+    if attempt_number >= max_attempts:
+        plan["expired_leads"].append((lead_name, max_attempts))
+        return
+    
+    # Only the name is reserved here, the row itself is copied from the previous task by insert_retry_tasks
+    retry_task_name = get_new_name("CRM Task")
+    plan["retry_tasks"].append((retry_task_name, previous_task_name, get_assign_value(assigned_to)))
+    
+    if assigned_to:
+        plan["todos"].append(make_bulk_row("ToDo", {
+            "allocated_to": assigned_to,
+            "reference_type": "CRM Task",
+            "reference_name": retry_task_name,
+            "description": f"Retry task assigned: Retry Call - Attempt {attempt_number + 1}",
+            "priority": "Medium",
+            "status": "Open"
+        }))
+
 
-        # Check if we've reached max attempts
-        if attempt_number >= max_attempts:
-            # Mark as processed first
-            previous_task.custom_retry_created = 1
-            previous_task.save(ignore_permissions=True)
+def apply_retry_plan(plan, today):
+    """
+    Write a retry plan to the database, the caller is responsible for committing
+    """
+    insert_retry_tasks(plan["retry_tasks"], today)
+    bulk_insert_rows("ToDo", plan["todos"])
+    
+    if plan["processed_tasks"]:
+        frappe.db.sql(
+            "UPDATE `tabCRM Task` SET custom_retry_created = 1, modified = %s, modified_by = %s WHERE name IN %s",
+            (now(), frappe.session.user, tuple(plan["processed_tasks"]))
+        )
+    
+    expire_leads(plan["expired_leads"])
 
-            # Update lead status to Inactive/Dropped
+
+def insert_retry_tasks(retry_tasks, today):
+    """
+    Create the retry tasks with a single INSERT ... SELECT over their previous tasks
+    retry_tasks is a list of (retry_task_name, previous_task_name, _assign) tuples
+    Names follow the CRM Task naming rule, so they are reserved in Python and joined in as a derived table
+    """
+    if not retry_tasks:
+        return
+    
+    names_table = " UNION ALL ".join(["SELECT %s AS name, %s AS previous_task, %s AS _assign"] * len(retry_tasks))
+    timestamp = now()
+    
+    frappe.db.sql(f"""
+        INSERT INTO `tabCRM Task` (
+            name, creation, modified, owner, modified_by,
+            title, assigned_to, status, priority, description,
+            reference_doctype, reference_docname, start_date, due_date,
+            custom_attempt_number, custom_max_attempts, custom_retry_interval_days,
+            custom_lead_name, custom_previous_task, custom_retry_created, _assign
+        )
+        SELECT
+            retry.name, %s, %s, %s, %s,
+            CONCAT('Retry Call - Attempt ', task.custom_attempt_number + 1),
+            task.assigned_to, 'Todo', 'Medium',
+            CONCAT('Retry task auto-created for lead ', IFNULL(task.custom_lead_name, ''),
+                ' - Attempt ', task.custom_attempt_number + 1, '/', task.custom_max_attempts),
+            'CRM Lead', task.custom_lead_name, %s, %s,
+            task.custom_attempt_number + 1, task.custom_max_attempts, 2,
+            task.custom_lead_name, task.name, 0, retry._assign
+        FROM `tabCRM Task` task
+        JOIN ({names_table}) retry ON retry.previous_task = task.name
+    """, (
+        timestamp, timestamp, frappe.session.user, frappe.session.user,
+        today, add_days(today, 2),
+        *(value for retry_task in retry_tasks for value in retry_task)
+    ))
+
+
+def expire_leads(expired_leads):
+    """
+    Move leads that ran out of attempts to Inactive/Dropped
+    expired_leads is a list of (lead_name, max_attempts) tuples
+    The status is saved through the CRM Lead controller so the status change log and version are kept,
+    only the comments are bulk inserted
+    A lead that fails to save is rolled back on its own and logged, the other leads are still dropped
+    """
+    max_attempts_by_lead = {lead_name: max_attempts for lead_name, max_attempts in expired_leads if lead_name}
+    if not max_attempts_by_lead:
+        return
+    
+    dropped_leads, failures = [], []
+    for lead_name in frappe.get_all("CRM Lead",
+        filters={
+            "name": ["in", list(max_attempts_by_lead)],
+            "status": ["!=", "Inactive / Dropped"]
+        },
+        pluck="name"
+    ):
+        # A lead failing validation must not roll back the rest of the chunk
+        frappe.db.savepoint("expire_lead")
+        try:
             lead_doc = frappe.get_doc("CRM Lead", lead_name)
             lead_doc.status = "Inactive / Dropped"
-            lead_doc.add_comment(
-                "Comment",
-                f"Lead status automatically changed to 'Inactive / Dropped' after {max_attempts} unsuccessful contact attempts"
-            )
             lead_doc.save(ignore_permissions=True)
-            frappe.db.commit()
-            
-            frappe.log_error(
-                message=f"Lead {lead_name} moved to Unqualified after {max_attempts} attempts",
-                title="Max Retry Attempts Reached"
-            )
-            return
-        
-        # Create new retry task
-        new_attempt = attempt_number + 1
-        retry_task = frappe.get_doc({
-            "doctype": "CRM Task",
-            "title": f"Retry Call - Attempt {new_attempt}",
-            "assigned_to": assigned_to,
-            "status": "Todo",
-            "priority": "Medium",
-            "description": f"Retry task auto-created for lead {lead_name} - Attempt {new_attempt}/{max_attempts}",
-            "reference_doctype": "CRM Lead",
-            "reference_docname": lead_name,
-            "start_date": nowdate(),
-            "due_date": add_days(nowdate(), 2),  # Due in 2 days
-            "custom_attempt_number": str(new_attempt),
-            "custom_max_attempts": str(max_attempts),
-            "custom_retry_interval_days": 2,
-            "custom_lead_name": lead_name,
-            "custom_previous_task": previous_task_name,
-            "custom_retry_created": 0  # Not yet processed
-        })
-        
-        retry_task.insert(ignore_permissions=True)
-        
-        previous_task.custom_retry_created = 1
-        previous_task.save(ignore_permissions=True)
-
-        # Create assignment
-        if assigned_to:
-            assignment = frappe.get_doc({
-                "doctype": "ToDo",
-                "allocated_to": assigned_to,
-                "reference_type": "CRM Task",
-                "reference_name": retry_task.name,
-                "description": f"Retry task assigned: {retry_task.title}",
-                "priority": "Medium",
-                "status": "Open"
-            })
-            assignment.insert(ignore_permissions=True)
-        
-        frappe.db.commit()
+        except Exception as e:
+            frappe.db.rollback(save_point="expire_lead")
+            failures.append(f"{lead_name}: {str(e)}")
+            continue
         
+        dropped_leads.append(lead_name)
+    
+    if failures:
         frappe.log_error(
-            message=f"Retry task {retry_task.name} created for lead {lead_name} - Attempt {new_attempt}/{max_attempts}",
-            title="Retry Task Created Successfully"
+            message="Error moving leads to Inactive / Dropped:\n" + "\n".join(failures),
+            title="Lead Expiry Error"
         )
-        
-    except Exception as e:
-        frappe.log_error(
-            message=f"Error creating retry task for lead {lead_name}: {str(e)}",
-            title="Retry Task Creation Error"
+    
+    # One comment per lead actually moved, not for leads that were dropped already
+    bulk_insert_rows("Comment", [
+        make_lead_comment_row(
+            lead_name,
+            f"Lead status automatically changed to 'Inactive / Dropped' after {max_attempts_by_lead[lead_name]} unsuccessful contact attempts"
         )
-        raise
+        for lead_name in dropped_leads
+    ])
+
+
+def make_lead_comment_row(lead_name, content):
+    """
+    Comment row for a CRM Lead, same values as lead_doc.add_comment("Comment", content)
+    """
+    return make_bulk_row("Comment", get_lead_comment_values(lead_name, content))
+
+
+def get_lead_comment_values(lead_name, content):
+    """
+    Values of a comment on a CRM Lead by the current user
+    """
+    return {
+        "comment_type": "Comment",
+        "reference_doctype": "CRM Lead",
+        "reference_name": lead_name,
+        "content": content,
+        "comment_email": frappe.session.user,
+        "comment_by": get_fullname(frappe.session.user)
+    }
+
+
+def queue_lead_comment(lead_name, content):
+    """
+    Add a comment to a CRM Lead as part of the bulk insert done on commit
+    Comment.on_update is skipped, so the lead's _comments is not updated, keep it for batches
+    """
+    defer_bulk_insert("Comment", make_lead_comment_row(lead_name, content))
+
+
+def add_lead_comment(lead_name, content):
+    """
+    Add a comment to a CRM Lead through the ORM, for single document paths
+    """
+    frappe.get_doc({
+        "doctype": "Comment",
+        **get_lead_comment_values(lead_name, content)
+    }).insert(ignore_permissions=True)
+
+
+def make_bulk_row(doctype, values):
+    """
+    Fill in the name and standard columns so a row can go through frappe.db.bulk_insert
+    """
+    timestamp = now()
+    
+    return {
+        "name": get_new_name(doctype),
+        "creation": timestamp,
+        "modified": timestamp,
+        "owner": frappe.session.user,
+        "modified_by": frappe.session.user,
+        **values
+    }
+
+
+def get_new_name(doctype):
+    """
+    Reserve a name for a row inserted without the ORM
+    Hash named doctypes skip building a Document, the (cached) meta is enough to tell
+    """
+    if frappe.get_meta(doctype).autoname in (None, "", "hash"):
+        return frappe.generate_hash(length=10)
+    
+    doc = frappe.new_doc(doctype)
+    set_new_name(doc)
+    return doc.name
+
+
+def bulk_insert_rows(doctype, rows, chunk_size=1000):
+    """
+    Insert rows built by make_bulk_row using multi-row INSERT statements
+    Keys that are not columns of the doctype are ignored, like get_doc does
+    """
+    if not rows:
+        return
+    
+    meta = frappe.get_meta(doctype)
+    valid_columns = set(meta.get_valid_columns())
+    if not meta.istable:
+        # Not a docfield, but every parent table has it and ToDo.on_update is skipped here
+        valid_columns.add("_assign")
+    fields = [
+        field for field in dict.fromkeys(field for row in rows for field in row)
+        if field in valid_columns
+    ]
+    frappe.db.bulk_insert(
+        doctype,
+        fields,
+        (tuple(row.get(field) for field in fields) for row in rows),
+        chunk_size=chunk_size
+    )
+
+
+def get_assign_value(user):
+    """
+    The _assign value ToDo.on_update would write on a document assigned to user
+    Needed when the document and its ToDo are inserted without the ORM
+    """
+    return json.dumps([user]) if user else None
+
+
+def raw_insert_doc(doctype, values):
+    """
+    Insert a child-less document without the ORM, the row is bulk inserted on commit
+    Controllers and validations are skipped, only use it for rows built in server code
+    Returns the row, including its reserved name
+    """
+    row = make_bulk_row(doctype, values)
+    defer_bulk_insert(doctype, row)
+    return row
+
+
+def in_batch_context():
+    """
+    True while documents are written in bulk (data import, patches)
+    List view bulk edits (frappe.desk.doctype.bulk_update) set neither flag and take the per-document path
+    """
+    return bool(frappe.flags.in_import or frappe.flags.in_patch)
+
+
+def defer_bulk_insert(doctype, row):
+    """
+    Buffer a row built by make_bulk_row until the current transaction commits
+    All buffered rows of a doctype then go through a single bulk_insert_rows call
+    """
+    pending_inserts = frappe.flags.indiazona_pending_inserts
+    if pending_inserts is None:
+        pending_inserts = frappe.flags.indiazona_pending_inserts = {}
+        frappe.db.before_commit.add(flush_deferred_inserts)
+        frappe.db.after_rollback.add(discard_deferred_inserts)
+    
+    pending_inserts.setdefault(doctype, []).append(row)
+
+
+def get_deferred_inserts(doctype):
+    """
+    Rows of doctype buffered by defer_bulk_insert and not written yet
+    """
+    return (frappe.flags.indiazona_pending_inserts or {}).get(doctype, [])
+
+
+def flush_deferred_inserts():
+    """
+    Write the rows buffered by defer_bulk_insert
+    """
+    pending_inserts = frappe.flags.pop("indiazona_pending_inserts", None) or {}
+    for doctype, rows in pending_inserts.items():
+        bulk_insert_rows(doctype, rows)
+
+
+def discard_deferred_inserts():
+    """
+    Drop the rows buffered by defer_bulk_insert when the transaction is rolled back
+    """
+    frappe.flags.pop("indiazona_pending_inserts", None)
 
 
 # ==========================================
@@ -220,32 +639,36 @@ def handle_task_status_change(doc, method=None):
     Hook to handle when task status changes
     Triggered on CRM Task update
     """
+    # Cheap check first, most saves are not one of these statuses
+    if doc.status not in ("Not Interested", "Interested"):
+        return
+    
     # Check if status changed
-    if doc.has_value_changed("status"):
-        old_status = doc.get_doc_before_save().status if doc.get_doc_before_save() else None
-        new_status = doc.status
-        
-        # Handle "Not Interested" status
-        if new_status == "Not Interested":
-            handle_not_interested_status(doc)
-        
-        # Handle "Interested" status
-        elif new_status == "Interested":
-            handle_interested_status(doc)
+    if not doc.has_value_changed("status"):
+        return
+    
+    # Handle "Not Interested" status
+    if doc.status == "Not Interested":
+        handle_not_interested_status(doc, defer=in_batch_context())
+    
+    # Handle "Interested" status
+    elif doc.status == "Interested":
+        handle_interested_status(doc)
 
 
-def handle_not_interested_status(task_doc):
+def handle_not_interested_status(task_doc, defer=False):
     """
     When task status is "Not Interested":
     1. Schedule email for 15 days (soft re-engagement)
     2. Schedule task for 30 days
+    With defer, the lead comment is bulk inserted together with the rest of the batch on commit
     """
     try:
         lead_name = task_doc.custom_lead_name
         if not lead_name:
             return
         
-        lead_doc = frappe.get_doc("CRM Lead", lead_name)
+        lead_doc = get_lead_contact(lead_name)
         
         # 1. Schedule email for 15 days later
         schedule_reengagement_email(
@@ -264,11 +687,14 @@ def handle_not_interested_status(task_doc):
         )
         
         # Add comment to lead
-        lead_doc.add_comment(
-            "Comment",
-            f"Lead marked as 'Not Interested'. Email scheduled for {add_days(nowdate(), 15)}, Follow-up task scheduled for {add_days(nowdate(), 30)}"
+        comment = (
+            f"Lead marked as 'Not Interested'. Email scheduled for {add_days(nowdate(), 15)}, "
+            f"Follow-up task scheduled for {add_days(nowdate(), 30)}"
         )
-        lead_doc.save(ignore_permissions=True)
+        if defer:
+            queue_lead_comment(lead_name, comment)
+        else:
+            add_lead_comment(lead_name, comment)
         
         frappe.msgprint(
             _("Not Interested workflow triggered: Email in 15 days, Task in 30 days"),
@@ -294,7 +720,7 @@ def handle_interested_status(task_doc):
         if not lead_name:
             return
         
-        lead_doc = frappe.get_doc("CRM Lead", lead_name)
+        lead_doc = get_lead_contact(lead_name)
         
         # 1. Send immediate email
         send_interested_email(lead_doc, task_doc)
@@ -309,11 +735,10 @@ def handle_interested_status(task_doc):
         )
         
         # Add comment to lead
-        lead_doc.add_comment(
-            "Comment",
+        add_lead_comment(
+            lead_name,
             f"Lead marked as 'Interested'. Welcome email sent, Follow-up task scheduled for {add_days(nowdate(), 2)}"
         )
-        lead_doc.save(ignore_permissions=True)
         
         frappe.msgprint(
             _("Interested workflow triggered: Email sent, Follow-up task in 2 days"),
@@ -328,31 +753,36 @@ def handle_interested_status(task_doc):
         )
 
 
+def get_lead_contact(lead_name):
+    """
+    The CRM Lead fields used by the status workflows, without loading the whole document
+    """
+    lead = frappe.db.get_value("CRM Lead", lead_name, ["name", "email", "first_name"], as_dict=True)
+    if not lead:
+        frappe.throw(_("CRM Lead {0} not found").format(lead_name), frappe.DoesNotExistError)
+    
+    return lead
+
+
 def schedule_reengagement_email(lead_doc, task_doc, days_after=15):
     """
     Schedule a soft re-engagement email
+    Queued through frappe.sendmail, which builds the MIME message the Email Queue needs
     """
     try:
-        # Create Email Queue entry scheduled for future
-        email_queue = frappe.get_doc({
-            "doctype": "Email Queue",
-            "sender": frappe.db.get_single_value("System Settings", "email_footer_address") or "noreply@example.com",
-            "recipients": lead_doc.email,
-            "subject": "We'd Love to Hear from You Again",
-            "message": get_reengagement_email_template(lead_doc),
-            "reference_doctype": "CRM Lead",
-            "reference_name": lead_doc.name,
-            "send_after": add_days(now_datetime(), days_after),
-            "status": "Not Sent"
-        })
-        email_queue.insert(ignore_permissions=True)
-        frappe.db.commit()
-        
-        frappe.log_error(
-            message=f"Re-engagement email scheduled for {lead_doc.name} on {add_days(nowdate(), days_after)}",
-            title="Re-engagement Email Scheduled"
+        # Queue the email, it is held back until send_after
+        frappe.sendmail(
+            recipients=[lead_doc.email],
+            sender=get_default_sender_email(),
+            subject="We'd Love to Hear from You Again",
+            message=get_reengagement_email_template(lead_doc),
+            send_after=add_days(now_datetime(), days_after),
+            reference_doctype="CRM Lead",
+            reference_name=lead_doc.name
         )
         
+        frappe.logger("indiazona_crm").info(f"Re-engagement email scheduled for {lead_doc.name} on {add_days(nowdate(), days_after)}")
+        
     except Exception as e:
         frappe.log_error(
             message=f"Error scheduling re-engagement email: {str(e)}",
@@ -360,6 +790,26 @@ def schedule_reengagement_email(lead_doc, task_doc, days_after=15):
         )
 
 
+def get_default_sender_email():
+    """
+    Sender address for scheduled emails, cached until System Settings change
+    """
+    sender = frappe.cache().get_value(DEFAULT_SENDER_CACHE_KEY)
+    if sender is None:
+        sender = frappe.db.get_single_value("System Settings", "email_footer_address") or "noreply@example.com"
+        frappe.cache().set_value(DEFAULT_SENDER_CACHE_KEY, sender, expires_in_sec=3600)
+    
+    return sender
+
+
+def clear_default_sender_email_cache(doc, method=None):
+    """
+    Hook to drop the cached sender address
+    Triggered on System Settings update
+    """
+    frappe.cache().delete_value(DEFAULT_SENDER_CACHE_KEY)
+
+
 def send_interested_email(lead_doc, task_doc):
     """
     Send immediate email to interested lead
@@ -373,10 +823,7 @@ def send_interested_email(lead_doc, task_doc):
             reference_name=lead_doc.name
         )
         
-        frappe.log_error(
-            message=f"Interested email sent to {lead_doc.name}",
-            title="Interested Email Sent"
-        )
+        frappe.logger("indiazona_crm").info(f"Interested email sent to {lead_doc.name}")
         
     except Exception as e:
         frappe.log_error(
@@ -390,10 +837,10 @@ def schedule_followup_task(lead_doc, task_doc, title, days_after, description):
     Create a follow-up task scheduled for future
     """
     try:
-        followup_task = frappe.get_doc({
-            "doctype": "CRM Task",
+        followup_task = raw_insert_doc("CRM Task", {
             "title": title,
             "assigned_to": task_doc.assigned_to,
+            "_assign": get_assign_value(task_doc.assigned_to),
             "status": "Todo",
             "priority": "High",
             "description": description,
@@ -405,28 +852,19 @@ def schedule_followup_task(lead_doc, task_doc, title, days_after, description):
             "custom_previous_task": task_doc.name
         })
         
-        followup_task.insert(ignore_permissions=True)
-        
         # Create assignment
         if task_doc.assigned_to:
-            assignment = frappe.get_doc({
-                "doctype": "ToDo",
+            raw_insert_doc("ToDo", {
                 "allocated_to": task_doc.assigned_to,
                 "reference_type": "CRM Task",
-                "reference_name": followup_task.name,
-                "description": f"Follow-up task assigned: {followup_task.title}",
+                "reference_name": followup_task["name"],
+                "description": f"Follow-up task assigned: {followup_task['title']}",
                 "priority": "High",
                 "status": "Open",
                 "date": add_days(nowdate(), days_after)
             })
-            assignment.insert(ignore_permissions=True)
-        
-        frappe.db.commit()
         
-        frappe.log_error(
-            message=f"Follow-up task {followup_task.name} scheduled for {add_days(nowdate(), days_after)}",
-            title="Follow-up Task Created"
-        )
+        frappe.logger("indiazona_crm").info(f"Follow-up task {followup_task['name']} scheduled for {add_days(nowdate(), days_after)}")
         
     except Exception as e:
         frappe.log_error(
@@ -439,40 +877,16 @@ def get_reengagement_email_template(lead_doc):
     """
     Soft re-engagement email template
     """
-    return f"""
-    <p>Dear {lead_doc.first_name or 'Valued Customer'},</p>
-    
-    <p>We noticed you showed interest in our services a couple of weeks ago.</p>
-    
-    <p>We understand that timing is everything, and we'd love to reconnect with you to see if there's anything we can help you with now.</p>
-    
-    <p>If you have any questions or would like to discuss how we can support you, please don't hesitate to reach out.</p>
-    
-    <p>Looking forward to hearing from you!</p>
-    
-    <p>Best regards,<br>
-    Your Team</p>
-    """
+    return REENGAGEMENT_EMAIL_TEMPLATE.substitute(first_name=lead_doc.first_name or "Valued Customer")
 
 
 def get_interested_email_template(lead_doc):
     """
     Interested lead email template
     """
-    return f"""
-    <p>Dear {lead_doc.first_name or 'Valued Customer'},</p>
-    
-    <p>Thank you so much for expressing interest in our services!</p>
-    
-    <p>We're excited to have the opportunity to work with you and help you achieve your goals.</p>
-    
-    <p>One of our team members will follow up with you within the next 2 days to discuss the next steps.</p>
-    
-    <p>In the meantime, if you have any questions, please feel free to reach out.</p>
-    
-    <p>Best regards,<br>
-    Your Team</p>
-    """
+    return INTERESTED_EMAIL_TEMPLATE.substitute(first_name=lead_doc.first_name or "Valued Customer")
+
+
 @frappe.whitelist()
 def create_callback_task(task_name, callback_datetime, notes=None):
     """
@@ -480,17 +894,17 @@ def create_callback_task(task_name, callback_datetime, notes=None):
     """
     try:
         # Get the original task
-        original_task = frappe.get_doc("CRM Task", task_name)
-        
-        # Update original task with callback datetime
-        original_task.custom_callback_datetime = callback_datetime
-        original_task.save(ignore_permissions=True)
+        original_task = frappe.db.get_value(
+            "CRM Task", task_name, ["title", "assigned_to", "custom_lead_name"], as_dict=True
+        )
+        if not original_task:
+            frappe.throw(_("CRM Task {0} not found").format(task_name), frappe.DoesNotExistError)
         
         # Create new callback task
-        callback_task = frappe.get_doc({
-            "doctype": "CRM Task",
+        callback_task = raw_insert_doc("CRM Task", {
             "title": f"Scheduled Callback - {original_task.title}",
             "assigned_to": original_task.assigned_to,
+            "_assign": get_assign_value(original_task.assigned_to),
             "status": "Todo",
             "priority": "High",
             "description": f"Scheduled callback task.\n\nOriginal task: {task_name}\n\nNotes: {notes or 'No additional notes'}",
@@ -498,51 +912,43 @@ def create_callback_task(task_name, callback_datetime, notes=None):
             "reference_docname": original_task.custom_lead_name,
             "start_date": frappe.utils.getdate(callback_datetime),
             "due_date": frappe.utils.getdate(callback_datetime),
-            "custom_callback_date__time": callback_datetime,
+            "custom_callback_date__time": frappe.utils.get_datetime(callback_datetime),
             "custom_lead_name": original_task.custom_lead_name,
             "custom_previous_task": task_name,
             "custom_callback_notification_sent": 0
         })
         
-        callback_task.insert(ignore_permissions=True)
-        
         # Create ToDo assignment
         if original_task.assigned_to:
-            assignment = frappe.get_doc({
-                "doctype": "ToDo",
+            raw_insert_doc("ToDo", {
                 "allocated_to": original_task.assigned_to,
                 "reference_type": "CRM Task",
-                "reference_name": callback_task.name,
+                "reference_name": callback_task["name"],
                 "description": f"Scheduled callback at {frappe.utils.format_datetime(callback_datetime)}",
                 "priority": "High",
                 "status": "Open",
                 "date": frappe.utils.getdate(callback_datetime)
             })
-            assignment.insert(ignore_permissions=True)
         
         # Add comment to lead
         if original_task.custom_lead_name:
-            lead_doc = frappe.get_doc("CRM Lead", original_task.custom_lead_name)
-            lead_doc.add_comment(
-                "Comment",
-                f"Callback scheduled for {frappe.utils.format_datetime(callback_datetime)}. Task: {callback_task.name}"
+            add_lead_comment(
+                original_task.custom_lead_name,
+                f"Callback scheduled for {frappe.utils.format_datetime(callback_datetime)}. Task: {callback_task['name']}"
             )
-            lead_doc.save(ignore_permissions=True)
         
         frappe.db.commit()
         
-        frappe.log_error(
-            message=f"Callback task {callback_task.name} created for {callback_datetime}",
-            title="Callback Task Created"
-        )
+        frappe.logger("indiazona_crm").info(f"Callback task {callback_task['name']} created for {callback_datetime}")
         
         return {
             "success": True,
-            "task_name": callback_task.name,
+            "task_name": callback_task["name"],
             "callback_datetime": callback_datetime
         }
         
     except Exception as e:
+        frappe.db.rollback()
         frappe.log_error(
             message=f"Error creating callback task: {str(e)}",
             title="Callback Task Creation Error"
@@ -564,38 +970,59 @@ def send_callback_notifications():
         notification_time_end = add_to_date(current_time, hours=1, minutes=30)  # 30 min window
         
         # Find tasks scheduled in the next hour that haven't been notified
-        upcoming_callbacks = frappe.get_all("CRM Task",
-            filters={
-                "custom_callback_date__time": ["between", [notification_time_start, notification_time_end]],
-                "custom_callback_notification_sent": 0,
-                "status": ["!=", "Completed"]
-            },
-            fields=["name", "title", "assigned_to", "custom_callback_date__time", "custom_lead_name"]
-        )
+        # Served by idx_crm_task_callback_due, no index hint so sites without it still work
+        upcoming_callbacks = frappe.db.sql("""
+            SELECT name, title, assigned_to, custom_callback_date__time, custom_lead_name
+            FROM `tabCRM Task`
+            WHERE custom_callback_notification_sent = 0
+                AND status != 'Completed'
+                AND custom_callback_date__time BETWEEN %s AND %s
+        """, (notification_time_start, notification_time_end), as_dict=True)
         
-        frappe.log_error(
-            message=f"Found {len(upcoming_callbacks)} upcoming callbacks to notify",
-            title="Callback Notifications Check"
-        )
+        frappe.logger("indiazona_crm").info(f"Found {len(upcoming_callbacks)} upcoming callbacks to notify")
+        
+        # Resolve all assignee emails with one query
+        user_ids = {task.assigned_to for task in upcoming_callbacks if task.assigned_to}
+        email_by_user = {}
+        if user_ids:
+            email_by_user = {
+                user.name: user.email
+                for user in frappe.db.get_values(
+                    "User", {"name": ["in", list(user_ids)]}, ["name", "email"], as_dict=True
+                )
+            }
         
         # Send notification for each task
+        failures = []
         for task in upcoming_callbacks:
-            send_callback_reminder_notification(task)
+            send_callback_reminder_notification(task, email_by_user, failures)
+        
+        frappe.db.commit()
+        
+        # One Error Log for the whole run, a broken mail setup would otherwise log every task
+        if failures:
+            frappe.log_error(
+                message="Error sending callback reminders:\n" + "\n".join(failures),
+                title="Callback Reminder Error"
+            )
             
     except Exception as e:
+        frappe.db.rollback()
         frappe.log_error(
             message=f"Error in callback notification check: {str(e)}",
             title="Callback Notification Error"
         )
 
 
-def send_callback_reminder_notification(task_data):
+def send_callback_reminder_notification(task_data, email_by_user=None, failures=None):
     """
     Send notification reminder for upcoming callback
+    email_by_user maps user ids to emails, when not given the email is looked up
+    With a failures list, errors are appended to it instead of being logged one by one
+    A failed reminder is rolled back on its own, the other reminders of the run are still committed
     """
+    frappe.db.savepoint("callback_reminder")
     try:
-        task_doc = frappe.get_doc("CRM Task", task_data['name'])
-        
         # Format callback time
         callback_time = frappe.utils.format_datetime(task_data['custom_callback_date__time'], "dd MMM yyyy, hh:mm a")
         
@@ -619,7 +1046,10 @@ def send_callback_reminder_notification(task_data):
         
         # Send email notification
         if task_data['assigned_to']:
-            user_email = frappe.db.get_value("User", task_data['assigned_to'], "email")
+            if email_by_user is None:
+                user_email = frappe.db.get_value("User", task_data['assigned_to'], "email")
+            else:
+                user_email = email_by_user.get(task_data['assigned_to'])
             
             if user_email:
                 frappe.sendmail(
@@ -641,16 +1071,19 @@ def send_callback_reminder_notification(task_data):
                 )
         
         # Mark notification as sent
-        task_doc.custom_callback_notification_sent = 1
-        task_doc.save(ignore_permissions=True)
-        frappe.db.commit()
-        
-        frappe.log_error(
-            message=f"Callback reminder sent for task {task_data['name']} to {task_data['assigned_to']}",
-            title="Callback Reminder Sent"
+        frappe.db.set_value(
+            "CRM Task", task_data['name'], "custom_callback_notification_sent", 1, update_modified=False
         )
         
+        frappe.logger("indiazona_crm").info(f"Callback reminder sent for task {task_data['name']} to {task_data['assigned_to']}")
+        
     except Exception as e:
+        frappe.db.rollback(save_point="callback_reminder")
+        
+        if failures is not None:
+            failures.append(f"{task_data['name']}: {str(e)}")
+            return
+        
         frappe.log_error(
             message=f"Error sending callback reminder for task {task_data['name']}: {str(e)}",
             title="Callback Reminder Error"
@@ -7,28 +7,35 @@ def update_status_log_owner_on_refresh(doc_name):
         return False
         
     try:
-        doc = frappe.get_doc("CRM Lead", doc_name)
-        
-        assigned_user = doc.lead_owner if hasattr(doc, 'lead_owner') else None
+        assigned_user = frappe.db.get_value("CRM Lead", doc_name, "lead_owner")
         
         if not assigned_user:
             return False
         
-        # Check if already updated (assume all rows have same log_owner when updated)
-        already_updated = True
-        for row in doc.status_change_log:
-            if row.log_owner != assigned_user:
-                already_updated = False
-                break
-        
-        if already_updated:
+        # Check if already updated, a plain read so the usual refresh takes no row locks
+        needs_update = frappe.db.sql("""
+            SELECT 1
+            FROM `tabCRM Status Change Log`
+            WHERE parent = %s
+                AND parenttype = 'CRM Lead'
+                AND parentfield = 'status_change_log'
+                AND (log_owner IS NULL OR log_owner != %s)
+            LIMIT 1
+        """, (doc_name, assigned_user))
+        
+        if not needs_update:
             return {"message": "Already updated", "updated": False}
-            
-        # Update all rows in status_change_log child table
-        for row in doc.status_change_log:
-            row.log_owner = assigned_user
         
-        doc.save(ignore_permissions=True)
+        # Update all rows in status_change_log child table that are not on the owner yet
+        frappe.db.sql("""
+            UPDATE `tabCRM Status Change Log`
+            SET log_owner = %s
+            WHERE parent = %s
+                AND parenttype = 'CRM Lead'
+                AND parentfield = 'status_change_log'
+                AND (log_owner IS NULL OR log_owner != %s)
+        """, (assigned_user, doc_name, assigned_user))
+        
         frappe.db.commit()
         
         return {"message": "Updated successfully", "updated": True}